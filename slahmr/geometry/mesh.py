@@ -1,6 +1,8 @@
 import os
 import numpy as np
+import torch
 import trimesh
+from torch.nn import functional as F
 
 
 def get_mesh_bb(mesh):
@@ -27,6 +29,27 @@ def get_scene_bb(meshes):
     return bb_mins.min(axis=0), bb_maxs.max(axis=0)
 
 
+def compute_vertex_normals(verts, faces, eps=1e-6):
+    """
+    area-weighted vertex normals for a batch of meshes with the same faces
+    :param verts (*, V, 3) tensor
+    :param faces (F, 3) long tensor
+    returns (*, V, 3) unit vertex normals
+    """
+    *dims, V, _ = verts.shape
+    verts = verts.reshape(-1, V, 3)
+    v0, v1, v2 = verts[:, faces[:, 0]], verts[:, faces[:, 1]], verts[:, faces[:, 2]]
+    # one cross product per face, shared by all three of its vertices
+    face_normals = torch.linalg.cross(v2 - v1, v0 - v1)  # (N, F, 3)
+    # scatter to all face corners at once, flat faces are (f0v0, f0v1, f0v2, f1v0, ...)
+    vert_normals = torch.zeros_like(verts)
+    vert_normals.index_add_(
+        1, faces.reshape(-1), face_normals.repeat_interleave(3, dim=1)
+    )
+    vert_normals = F.normalize(vert_normals, p=2, dim=-1, eps=eps)
+    return vert_normals.reshape(*dims, V, 3)
+
+
 def make_batch_mesh(verts, faces, colors):
     """
     convenience function to make batch of meshes
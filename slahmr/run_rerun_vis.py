@@ -1,20 +1,21 @@
 """Visualize SLAHMR results with rerun."""
 
 import os
-from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
 
 import numpy as np
-import pytorch3d.structures
 import rerun as rr
 from rerun.components import Material
 import torch
 from matplotlib import colormaps
 from omegaconf import OmegaConf
-from scipy.spatial import transform
 
 from slahmr.body_model import run_smpl
 from slahmr.data import dataset, expand_source_paths, get_dataset_from_cfg
-from slahmr.run_vis import get_input_dict, get_results_paths, load_result
+from slahmr.geometry.mesh import compute_vertex_normals
+from slahmr.geometry.rotation import rotation_matrix_to_quaternion
+from slahmr.optim.output import get_results_paths, load_result
 from slahmr.util.loaders import (
     load_config_from_log,
     load_smpl_body_model,
@@ -25,6 +26,39 @@ from slahmr.util.tensor import get_device, move_to
 # define mapping from integer to RGB
 _index_to_color = lambda x, cmap="tab10": colormaps[cmap](x % colormaps[cmap].N)
 
+# see vis.tools.vis_keypoints and ViTPose/mmpose/apis/inference.py
+SKELETON_IDS = np.array(
+    [
+        [15, 13],
+        [13, 11],
+        [16, 14],
+        [14, 12],
+        [11, 12],
+        [5, 11],
+        [6, 12],
+        [5, 6],
+        [5, 7],
+        [6, 8],
+        [7, 9],
+        [8, 10],
+        [1, 2],
+        [0, 1],
+        [0, 2],
+        [1, 3],
+        [2, 4],
+        [3, 5],
+        [4, 6],
+    ],
+    dtype=np.int64,
+)
+# see vis.tools.imshow_keypoints
+IDCS = np.array(
+    [0, 16, 15, 18, 17, 5, 2, 6, 3, 7, 4, 12, 9, 13, 10, 14, 11], dtype=np.int64
+)
+
+# body models keyed by (smpl path, batch size, device), reused across phases and runs
+_BODY_MODEL_CACHE = {}
+
 
 def log_to_rerun(
     cfg: dict,
@@ -34,6 +68,9 @@ def log_to_rerun(
     phases: List[str] = ["motion_chunks"],
     phase_labels: Optional[List[str]] = None,
     save_dir: Optional[str] = None,
+    flush_tick_secs: Optional[float] = None,
+    flush_num_bytes: Optional[int] = None,
+    smpl_chunk_size: int = 64,
 ) -> None:
     assert phase_labels is None or len(phases) == len(phase_labels)
 
@@ -44,6 +81,13 @@ def log_to_rerun(
     if phase_labels is None:
         phase_labels = [f"{i}_{p}" for i, p in enumerate(phases)]
 
+    # rerun batches logged rows before serializing them to the sink, the batcher
+    #  thresholds are read from the environment when the recording is created
+    if flush_tick_secs is not None:
+        os.environ["RERUN_FLUSH_TICK_SECS"] = str(flush_tick_secs)
+    if flush_num_bytes is not None:
+        os.environ["RERUN_FLUSH_NUM_BYTES"] = str(flush_num_bytes)
+
     rr.init("slahmr", spawn=save_dir is None)
     if save_dir is not None:
         rr.save(os.path.join(save_dir, "log.rrd"))
@@ -52,32 +96,72 @@ def log_to_rerun(
     #  assuming camera is upright, and following RDF convention, Y will be down
     rr.log("world", rr.ViewCoordinates.RIGHT_HAND_Y_DOWN, timeless=True)
 
+    # dataset-side inputs are the same for every phase, prepare them once
     dataset.load_data()
+    cam_data = dataset.get_camera_data()
+    bones_xy, good_bones = get_skeleton_2d(dataset)
+    # -1 out of frame, 0 occluded, 1 visible (B, T)
+    vis_mask = np.stack([np.asarray(m) for m in dataset.data_dict["vis_mask"]], axis=0)
 
-    for phase, phase_label in zip(phases, phase_labels):
-        log_pinhole_camera(dataset, phase_label)
-        log_input_frames(dataset, phase_label)
-        log_skeleton_2d(dataset, phase_label)
+    device = get_device(dev_id)
+    cfg = resolve_cfg_paths(cfg)
+    # run the body model on chunks of frames to bound peak GPU memory on long sequences
+    chunk_size = min(smpl_chunk_size, dataset.seq_len)
+    body_model = get_body_model(cfg.paths.smpl, len(dataset) * chunk_size, device)
+
+    # load the results of later phases in the background while earlier ones are logged
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        futures = [
+            executor.submit(load_phase_result, dataset, log_dir, phase)
+            for phase in phases
+        ]
+        for phase, phase_label, future in zip(phases, phase_labels, futures):
+            log_pinhole_camera(dataset, cam_data, phase_label)
+            log_input_frames(dataset, phase_label)
+            log_skeleton_2d(bones_xy, good_bones, phase_label)
 
-        phase_dir = os.path.join(log_dir, phase)
-        if phase == "input":
-            res = get_input_dict(dataset)
-            it = f"{0:06d}"
+            res = future.result()
+            if res is None:
+                continue
 
-        elif os.path.isdir(phase_dir):
-            res_path_dict = get_results_paths(phase_dir)
-            it = sorted(res_path_dict.keys())[-1]
-            res = load_result(res_path_dict[it])["world"]
-        else:
-            print(f"{phase_dir} does not exist, skipping")
-            continue
+            log_phase_result(
+                body_model, dataset, dev_id, phase, phase_label, res, vis_mask
+            )
+
+
+def load_phase_result(
+    dataset: dataset.MultiPeopleDataset, log_dir: str, phase: str
+) -> Optional[dict]:
+    """Load the final world results of one phase, None if the phase has none."""
+    phase_dir = os.path.join(log_dir, phase)
+    if phase == "input":
+        # run_vis pulls in the pyrender based renderer, only import it when needed
+        from slahmr.run_vis import get_input_dict
+
+        return get_input_dict(dataset)
+
+    if not os.path.isdir(phase_dir):
+        print(f"{phase_dir} does not exist, skipping")
+        return None
+
+    res_path_dict = get_results_paths(phase_dir)
+    it = sorted(res_path_dict.keys())[-1]
+    return load_result(res_path_dict[it])["world"]
 
-        log_phase_result(cfg, dataset, dev_id, phase, phase_label, res)
 
+def get_body_model(smpl_path: str, batch_size: int, device: torch.device):
+    """Load the SMPL body model, reusing a cached instance if one exists."""
+    key = (smpl_path, batch_size, str(device))
+    if key not in _BODY_MODEL_CACHE:
+        body_model, _ = load_smpl_body_model(smpl_path, batch_size, device=device)
+        _BODY_MODEL_CACHE[key] = body_model
+    return _BODY_MODEL_CACHE[key]
 
-def log_pinhole_camera(dataset: dataset.MultiPeopleDataset, phase_label: str) -> None:
+
+def log_pinhole_camera(
+    dataset: dataset.MultiPeopleDataset, cam_data: dict, phase_label: str
+) -> None:
     """Log camera trajectory to rerun."""
-    cam_data = dataset.get_camera_data()
     fx, fy, cx, cy = cam_data["intrins"][0]
     width, height = dataset.img_size
     rr.set_time_sequence(f"frame_id_{phase_label}", 0)
@@ -94,85 +178,141 @@ def log_pinhole_camera(dataset: dataset.MultiPeopleDataset, phase_label: str) ->
 
 
 def log_phase_result(
-    cfg,
+    body_model,
     dataset: dataset.MultiPeopleDataset,
     dev_id,
     phase: str,
     phase_label: str,
     phase_result: dict,
+    vis_mask: np.ndarray,
 ) -> None:
     """Log results from one phase."""
     B = len(dataset)
     num_frames = dataset.seq_len
-    vis_mask = dataset.data_dict["vis_mask"]  # -1 out of frame, 0 occluded, 1 visible
     device = get_device(dev_id)
     phase_result = move_to(phase_result, device)
 
-    cfg = resolve_cfg_paths(cfg)
-    body_model, _ = load_smpl_body_model(cfg.paths.smpl, B * num_frames, device=device)
-
-    with torch.no_grad():
-        world_smpl = run_smpl(
-            body_model,
-            phase_result["trans"],
-            phase_result["root_orient"],
-            phase_result["pose_body"],
-            phase_result.get("betas", None),
-        )
-
-    # compute vertex normals on GPU
-    num_tracks = world_smpl["vertices"].shape[0]
-    num_meshes = num_tracks * num_frames
-    num_vertices = world_smpl["vertices"].shape[-2]
-    num_faces = world_smpl["faces"].shape[-2]
-
-    # faces has no batch dim here, use expand to avoid copy
-    meshes = pytorch3d.structures.Meshes(
-        verts=world_smpl["vertices"].reshape(num_meshes, num_vertices, 3),
-        faces=world_smpl["faces"].expand(num_meshes, num_faces, 3),
-    )
-
-    vertices = world_smpl["vertices"].numpy(force=True)
-    faces = world_smpl["faces"].numpy(force=True)
-    vertex_normals = (
-        meshes.verts_normals_padded()
-        .reshape(num_tracks, num_frames, num_vertices, 3)
-        .numpy(force=True)
-    )
+    # body model batch holds chunk_size frames of every track
+    chunk_size = body_model.bm.batch_size // B
+    trans = phase_result["trans"].reshape(B, num_frames, -1)
+    root_orient = phase_result["root_orient"].reshape(B, num_frames, -1)
+    pose_body = phase_result["pose_body"].reshape(B, num_frames, -1)
+
+    # copy chunks asynchronously into page-locked host buffers, time-major so each
+    #  chunk is a contiguous slice, and synchronize once after the last chunk
+    # NOTE: unit normals keep enough precision in fp16 to halve their transfer and
+    #  host memory, positions stay fp32 as mm-level quantization would be visible
+    pin_memory = device.type == "cuda"
+    num_vertices = body_model.bm.v_template.shape[0]
+    buf_shape = (num_frames, B, num_vertices, 3)
+    vertices = torch.empty(buf_shape, dtype=torch.float32, pin_memory=pin_memory)
+    vertex_normals = torch.empty(buf_shape, dtype=torch.float16, pin_memory=pin_memory)
+    with torch.inference_mode():
+        for start in range(0, num_frames, chunk_size):
+            end = min(start + chunk_size, num_frames)
+            world_smpl = run_smpl(
+                body_model,
+                trans[:, start:end],
+                root_orient[:, start:end],
+                pose_body[:, start:end],
+                phase_result.get("betas", None),
+            )
+            # compute vertex normals on GPU for all tracks in the chunk at once
+            chunk_normals = compute_vertex_normals(
+                world_smpl["vertices"], world_smpl["faces"]
+            )
+            vertices[start:end].copy_(
+                world_smpl["vertices"].transpose(0, 1), non_blocking=pin_memory
+            )
+            vertex_normals[start:end].copy_(
+                chunk_normals.half().transpose(0, 1), non_blocking=pin_memory
+            )
+
+    if pin_memory:
+        torch.cuda.current_stream(device).synchronize()
+    vertices = vertices.numpy()
+    vertex_normals = vertex_normals.numpy()
+    # rerun stores triangle indices as uint32, convert once instead of for every mesh
+    faces = np.ascontiguousarray(world_smpl["faces"].numpy(force=True), dtype=np.uint32)
 
     # NOTE: if the meshes don't deform over time or are similar we could use the same
     #  vertex normals for all frames and/or tracks
 
-    for frame_id in range(num_frames):
+    # convert the whole camera trajectory on device, (T, 3) and (T, 4) wxyz -> xyzw
+    cam_t = phase_result["cam_t"][1].numpy(force=True)
+    cam_q = rotation_matrix_to_quaternion(phase_result["cam_R"][1])
+    cam_q = cam_q[..., [1, 2, 3, 0]].numpy(force=True)
+
+    # log the meshes of each track from its own thread while the main thread logs
+    #  the camera, rerun timelines are thread-local so each track sets its own
+    with ThreadPoolExecutor(max_workers=B) as executor:
+        futures = [
+            executor.submit(
+                log_track_meshes,
+                phase_label,
+                i,
+                vertices[:, i],
+                faces,
+                vertex_normals[:, i],
+                vis_mask[i],
+            )
+            for i, _ in enumerate(dataset.track_ids)
+        ]
+
+        for frame_id in range(num_frames):
+            rr.set_time_sequence(f"frame_id_{phase_label}", frame_id)
+            rr.set_time_sequence("frame_id", frame_id)
+            rr.log(
+                f"world/{phase_label}/camera",
+                rr.Transform3D(
+                    translation=cam_t[frame_id],
+                    rotation=rr.Quaternion(xyzw=cam_q[frame_id]),
+                    from_parent=True,
+                ),
+            )
+        rr.set_time_sequence(f"frame_id_{phase_label}", None)
+
+        for future in futures:
+            future.result()
+
+
+def log_track_meshes(
+    phase_label: str,
+    track_idx: int,
+    vertices: np.ndarray,
+    faces: np.ndarray,
+    vertex_normals: np.ndarray,
+    vis_mask: np.ndarray,
+) -> None:
+    """Log the meshes of one track for all frames to rerun."""
+    in_frame = vis_mask >= 0
+    # a clear persists until the next mesh, only log it where an out of frame run starts
+    clear = get_run_starts(~in_frame)
+    for frame_id in np.where(in_frame | clear)[0].tolist():
         rr.set_time_sequence(f"frame_id_{phase_label}", frame_id)
         rr.set_time_sequence("frame_id", frame_id)
-        translation = phase_result["cam_t"][1, frame_id].numpy(force=True)
-        rotation_mat = phase_result["cam_R"][1, frame_id].numpy(force=True)
-        rotation_q = transform.Rotation.from_matrix(rotation_mat).as_quat()
-        rr.log(
-            f"world/{phase_label}/camera",
-            rr.Transform3D(
-                translation=translation,
-                rotation=rr.Quaternion(xyzw=rotation_q),
-                from_parent=True,
-            ),
-        )
-        for i, _ in enumerate(dataset.track_ids):
-            if vis_mask[i][frame_id] >= 0:
-                rr.log(
-                    f"world/{phase_label}/#{i}",
-                    rr.Mesh3D(
-                        vertex_positions=vertices[i, frame_id],
-                        indices=faces,
-                        vertex_normals=vertex_normals[i, frame_id],
-                        mesh_material=Material(albedo_factor=_index_to_color(i)),
-                    )
+        if in_frame[frame_id]:
+            rr.log(
+                f"world/{phase_label}/#{track_idx}",
+                rr.Mesh3D(
+                    vertex_positions=vertices[frame_id],
+                    indices=faces,
+                    vertex_normals=vertex_normals[frame_id].astype(np.float32),
+                    mesh_material=Material(albedo_factor=_index_to_color(track_idx)),
                 )
-            else:
-                rr.log(f"world/{phase_label}/#{i}", rr.Clear(recursive=True))
+            )
+        else:
+            rr.log(f"world/{phase_label}/#{track_idx}", rr.Clear(recursive=True))
     rr.set_time_sequence(f"frame_id_{phase_label}", None)
 
 
+def get_run_starts(mask: np.ndarray) -> np.ndarray:
+    """Mark the first frame of every run of True values along the last axis."""
+    prev = np.zeros_like(mask)
+    prev[..., 1:] = mask[..., :-1]
+    return mask & ~prev
+
+
 def log_input_frames(dataset: dataset.MultiPeopleDataset, phase_label: str) -> None:
     """Log raw input video to rerun."""
     for frame_id, img_path in enumerate(dataset.sel_img_paths):
@@ -182,43 +322,35 @@ def log_input_frames(dataset: dataset.MultiPeopleDataset, phase_label: str) -> N
     rr.set_time_sequence(f"frame_id_{phase_label}", None)
 
 
-def log_skeleton_2d(dataset: dataset.MultiPeopleDataset, phase_label: str) -> None:
+def get_skeleton_2d(
+    dataset: dataset.MultiPeopleDataset,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Get 2D bones of all tracks and frames
+    returns bone end points (B, T, 19, 2, 2) and mask of confident bones (B, T, 19)
+    """
+    # gather the bone end points for all tracks and frames at once
+    joints2d = np.stack(dataset.data_dict["joints2d"], axis=0)  # (B, T, J, 3)
+    bones = joints2d[:, :, IDCS][:, :, SKELETON_IDS]  # (B, T, 19, 2, 3)
+    good_bones = bones[..., 2].min(axis=-1) > 0.3  # min conf per bone
+    return bones[..., :2], good_bones
+
+
+def log_skeleton_2d(
+    bones_xy: np.ndarray, good_bones: np.ndarray, phase_label: str
+) -> None:
     """Log 2D skeleton to rerun."""
-    # see vis.tools.vis_keypoints and ViTPose/mmpose/apis/inference.py
-    SKELETON_IDS = np.array(
-        [
-            [15, 13],
-            [13, 11],
-            [16, 14],
-            [14, 12],
-            [11, 12],
-            [5, 11],
-            [6, 12],
-            [5, 6],
-            [5, 7],
-            [6, 8],
-            [7, 9],
-            [8, 10],
-            [1, 2],
-            [0, 1],
-            [0, 2],
-            [1, 3],
-            [2, 4],
-            [3, 5],
-            [4, 6],
-        ]
-    )
-    # see vis.tools.imshow_keypoints
-    IDCS = [0, 16, 15, 18, 17, 5, 2, 6, 3, 7, 4, 12, 9, 13, 10, 14, 11]
-    for i, _ in enumerate(dataset.track_ids):
-        joints2d = dataset.data_dict["joints2d"][i]  # (T, J, 3)
-        for frame_id, frame_joints in enumerate(joints2d):
-            joints = frame_joints[IDCS][SKELETON_IDS]
-            joint_confidence = joints[..., 2].min(axis=-1)  # min conf per joint
-            good_joints_xy = joints[joint_confidence > 0.3, :, :2]
+    num_tracks, num_frames = good_bones.shape[:2]
+    # only clear the skeleton where a run of frames without good bones starts
+    clear = get_run_starts(~good_bones.any(axis=-1))  # (B, T)
+
+    # iterate over frames first so the timeline is set once per frame, not per track
+    for frame_id in range(num_frames):
+        rr.set_time_sequence(f"frame_id_{phase_label}", frame_id)
+        rr.set_time_sequence("frame_id", frame_id)
+        for i in range(num_tracks):
+            good_joints_xy = bones_xy[i, frame_id, good_bones[i, frame_id]]
 
-            rr.set_time_sequence(f"frame_id_{phase_label}", frame_id)
-            rr.set_time_sequence("frame_id", frame_id)
             if len(good_joints_xy):
                 rr.log(
                     f"world/{phase_label}/camera/image/skeleton/#{i}",
@@ -227,7 +359,7 @@ def log_skeleton_2d(dataset: dataset.MultiPeopleDataset, phase_label: str) -> No
                         colors=_index_to_color(i),
                     ),
                 )
-            else:
+            elif clear[i, frame_id]:
                 rr.log(
                     f"world/{phase_label}/camera/image/skeleton/#{i}",
                     rr.Clear(recursive=True)
@@ -235,6 +367,54 @@ def log_skeleton_2d(dataset: dataset.MultiPeopleDataset, phase_label: str) -> No
     rr.set_time_sequence(f"frame_id_{phase_label}", None)
 
 
+# command line args and GPU of a pool worker, set once by its initializer
+_WORKER_ARGS = None
+_WORKER_DEV_ID = None
+
+
+def init_worker(args, gpu_queue):
+    global _WORKER_ARGS, _WORKER_DEV_ID
+    _WORKER_ARGS = args
+    # each worker takes one GPU and runs all of its jobs there
+    _WORKER_DEV_ID = gpu_queue.get()
+    if torch.cuda.is_available():
+        torch.cuda.set_device(get_device(_WORKER_DEV_ID))
+    # spawned workers don't inherit resolvers registered in the main process
+    OmegaConf.register_new_resolver("eval", eval)
+
+
+def launch_worker(i):
+    launch_rerun_vis(i, _WORKER_ARGS, _WORKER_DEV_ID)
+
+
+def launch_rerun_vis(i, args, dev_id):
+    log_dir = args.log_dirs[i]
+    path_name = log_dir.split(args.log_root)[-1].strip("/")
+    exp_name = "-".join(path_name.split("/")[:2])
+    cfg = load_config_from_log(log_dir)
+    cfg.data.sources = expand_source_paths(cfg.data.sources)
+    print("SOURCES", cfg.data.sources)
+    dataset = get_dataset_from_cfg(cfg)
+
+    save_dir = None
+    if args.save_root:
+        save_dir = f"{args.save_root}/{exp_name}"
+        os.makedirs(save_dir, exist_ok=True)
+
+    log_to_rerun(
+        cfg,
+        dataset,
+        log_dir,
+        dev_id,
+        phases=args.phases,
+        phase_labels=args.phase_labels,
+        save_dir=save_dir,
+        flush_tick_secs=args.flush_tick_secs,
+        flush_num_bytes=args.flush_num_bytes,
+        smpl_chunk_size=args.smpl_chunk_size,
+    )
+
+
 def main(args):
     """
     visualize all runs in root
@@ -247,29 +427,29 @@ def main(args):
     args.log_dirs = log_dirs
     print(f"FOUND {len(args.log_dirs)} TO RENDER")
 
-    for log_dir in args.log_dirs:
-        dev_id = 0
-        path_name = log_dir.split(args.log_root)[-1].strip("/")
-        exp_name = "-".join(path_name.split("/")[:2])
-        cfg = load_config_from_log(log_dir)
-        cfg.data.sources = expand_source_paths(cfg.data.sources)
-        print("SOURCES", cfg.data.sources)
-        dataset = get_dataset_from_cfg(cfg)
-
-        save_dir = None
-        if args.save_root:
-            save_dir = f"{args.save_root}/{exp_name}"
-            os.makedirs(save_dir, exist_ok=True)
-
-        log_to_rerun(
-            cfg,
-            dataset,
-            log_dir,
-            dev_id,
-            phases=args.phases,
-            phase_labels=args.phase_labels,
-            save_dir=save_dir,
-        )
+    if len(args.gpus) > 1:
+        from torch.multiprocessing import Pool
+
+        torch.multiprocessing.set_start_method("spawn")
+        gpu_queue = torch.multiprocessing.Queue()
+        for dev_id in args.gpus:
+            gpu_queue.put(dev_id)
+
+        # args are sent to each worker once, jobs are drained as they finish
+        chunksize = max(1, len(args.log_dirs) // (4 * len(args.gpus)))
+        with Pool(
+            processes=len(args.gpus),
+            initializer=init_worker,
+            initargs=(args, gpu_queue),
+        ) as pool:
+            for _ in pool.imap_unordered(
+                launch_worker, range(len(args.log_dirs)), chunksize=chunksize
+            ):
+                pass
+        return
+
+    for i in range(len(args.log_dirs)):
+        launch_rerun_vis(i, args, args.gpus[i % len(args.gpus)])
 
 
 if __name__ == "__main__":
@@ -285,6 +465,9 @@ if __name__ == "__main__":
     )
     parser.add_argument("--phase_labels", nargs="*", default=None)
     parser.add_argument("--gpus", nargs="*", default=[0])
+    parser.add_argument("--flush_tick_secs", type=float, default=None)
+    parser.add_argument("--flush_num_bytes", type=int, default=None)
+    parser.add_argument("--smpl_chunk_size", type=int, default=64)
     args = parser.parse_args()
 
     main(args)